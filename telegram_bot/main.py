@@ -2,16 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import time
+import asyncio
 import logging
-import uuid
-import random
-import string
-from datetime import datetime, timedelta, timezone
-import magic # Detect mime types
-import requests # For Ollama HTTP requests and Mailgun API calls
-import json # For parsing Ollama response more reliably
+import secrets
+import functools
+import weakref
+from enum import IntEnum
+from typing import Final
+from io import BytesIO
+from datetime import date, datetime, timedelta, timezone
+import httpx # Async HTTP clients for Ollama, Mailgun and Supabase API calls
+from cachetools import TTLCache # In-process caches for hot DB lookups
+import orjson # Fast JSON parsing of Ollama responses
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Update, Message
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -19,11 +27,14 @@ from telegram.ext import (
     filters,
     ContextTypes,
     ConversationHandler,
+    BasePersistence,
+    PersistenceInput,
+    BaseUpdateProcessor,
     CallbackQueryHandler # Included, though not used in current logic
 )
-from supabase import create_client, Client
-import openai # Using openai lib structure for Whisper
-from dateutil.parser import isoparse # For parsing iso string from DB
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
+import asyncpg # Pooled async Postgres access for bot-side queries
+from openai import AsyncOpenAI # Async client for the Whisper transcription API
 
 # --- Configuration & Initialization ---
 load_dotenv() # Load variables from .env file
@@ -39,10 +50,29 @@ logger = logging.getLogger(__name__)
 
 # --- Environment Variables ---
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Optional self-hosted telegram-bot-api server, e.g. "http://127.0.0.1:8081/bot"
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+TELEGRAM_API_FILE_URL = os.getenv("TELEGRAM_API_FILE_URL") # Defaults to <server>/file/bot
+TELEGRAM_LOCAL_MODE = os.getenv("TELEGRAM_LOCAL_MODE", "false").lower() == "true" # Server started with --local
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY") # Use Service Key for admin actions
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL") # Direct Postgres connection string (Project Settings > Database)
+# asyncpg prepared-statement cache per connection. Set to 0 when SUPABASE_DB_URL points at
+# the Supavisor transaction pooler (port 6543), which can't keep prepared statements.
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# Seconds a linked profile stays cached. Links change rarely and the bot's own /link and
+# /unlink bust the entry; lower this if accounts are often unlinked from the web app.
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "3600"))
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "deepseek-coder:6.7b") # Or your preferred model
+# Max concurrent requests sent to Ollama. Keep in line with the Ollama server's own
+# OLLAMA_NUM_PARALLEL (and OLLAMA_MAX_LOADED_MODELS if several models are served).
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+# How long Ollama keeps the model (and its prompt cache) loaded between requests, e.g. "30m" or "-1"
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE")
+# Upper bounds on the task context put into each prompt; prompt length drives Ollama's prefill time
+TASK_CONTEXT_LIMIT = int(os.getenv("TASK_CONTEXT_LIMIT", "20"))
+TASK_CONTEXT_MAX_CHARS = int(os.getenv("TASK_CONTEXT_MAX_CHARS", "3800"))
 MAILGUN_API_KEY = os.getenv("MAILGUN_API_KEY")
 MAILGUN_DOMAIN = os.getenv("MAILGUN_DOMAIN")
 MAILGUN_FROM_EMAIL = os.getenv("MAILGUN_FROM_EMAIL")
@@ -50,161 +80,259 @@ MAILGUN_FROM_EMAIL = os.getenv("MAILGUN_FROM_EMAIL")
 MAILGUN_API_BASE_URL = os.getenv("MAILGUN_API_URL", "https://api.mailgun.net/v3")
 
 # Whisper Config (Ensure API Key or Base URL is set if using OpenAI API)
-openai.api_key = os.getenv("OPENAI_API_KEY")
-if os.getenv("WHISPER_API_BASE"):
-    openai.api_base = os.getenv("WHISPER_API_BASE")
-# Add checks later if Whisper API key/base is strictly required
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+WHISPER_API_BASE = os.getenv("WHISPER_API_BASE") # Optional OpenAI-compatible Whisper server
+WHISPER_LOCAL_MODEL = os.getenv("WHISPER_LOCAL_MODEL") # e.g. "small"; transcribe in-process with faster-whisper instead of the API
+WHISPER_DEVICE = os.getenv("WHISPER_DEVICE", "auto") # "cuda", "cpu" or "auto"
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE") # Defaults to int8 weights; see _get_whisper_model
+REDIS_URL = os.getenv("REDIS_URL") # Optional; persists /link conversation state across bot restarts
 
 # --- Supabase Client ---
-supabase: Client | None = None
-if SUPABASE_URL and SUPABASE_KEY:
-    try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-        logger.info("Supabase client initialized.")
-    except Exception as e:
-        logger.error(f"Failed to initialize Supabase client: {e}", exc_info=True)
-else:
+# Async client created once in post_init and shared by all handlers. It is handed the
+# shared HTTP client below, so PostgREST calls reuse its keep-alive HTTP/2 connections.
+supabase: AsyncClient | None = None
+if not (SUPABASE_URL and SUPABASE_KEY):
     logger.error("Supabase URL or Key missing in environment variables.")
 
+# --- Postgres Connection Pool ---
+# Created in post_init (needs a running event loop) and closed in post_shutdown.
+# Reusing connections avoids per-query connection setup and asyncpg's per-connection
+# statement cache amortizes query parsing across calls. Sized well under Supabase's
+# direct connection limit; idle connections are recycled after 5 minutes.
+DB_POOL: asyncpg.Pool | None = None
+
+# --- In-Process Caches ---
+# Linked profiles keyed by telegram_id; saves a DB round trip on every message from a
+# linked user. Invalidated on link/unlink. Single-process only (move to Redis if the bot is scaled out).
+_profile_cache: TTLCache = TTLCache(maxsize=10_000, ttl=PROFILE_CACHE_TTL)
+# Rendered task context keyed by Supabase user UUID; short TTL since tasks can also
+# change from the web app. Busted by the bot's own write intents.
+_ctx_cache: TTLCache = TTLCache(maxsize=10_000, ttl=15)
+
+# --- Voice Format ---
+# Telegram voice notes are OGG/Opus; every Ogg page starts with this capture pattern
+OGG_MAGIC = b"OggS"
+
+# --- Shared HTTP Clients ---
+# Single async client reused for Mailgun and Supabase so calls don't block the event loop
+# and keep-alive connections skip the TCP/TLS handshake. Closed in post_shutdown.
+HTTP = httpx.AsyncClient(
+    timeout=180, http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+)
+# Ollama gets its own client so its connections stay warm for the next prompt, and an
+# unreachable server fails fast on connect instead of waiting out the 180s generation timeout.
+# Plain HTTP/1.1: a local Ollama has no TLS, so there's no HTTP/2 to negotiate.
+OLLAMA_HTTP = httpx.AsyncClient(
+    base_url=OLLAMA_BASE_URL, timeout=httpx.Timeout(180, connect=5),
+    limits=httpx.Limits(max_connections=OLLAMA_NUM_PARALLEL * 2, max_keepalive_connections=OLLAMA_NUM_PARALLEL * 2)
+)
+# Bounds in-flight Ollama calls so concurrent users don't overwhelm the local model
+_ollama_sem = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+# Min seconds between edits of a streamed reply. Telegram throttles edits per chat, and
+# ~1/s keeps long answers from hitting flood control mid-stream.
+STREAM_EDIT_INTERVAL = 1.0
+
+# --- Whisper Client ---
+whisper_client: AsyncOpenAI | None = None
+if OPENAI_API_KEY or WHISPER_API_BASE:
+    # Self-hosted Whisper servers usually ignore the key, but the client requires one
+    whisper_client = AsyncOpenAI(api_key=OPENAI_API_KEY or "unused", base_url=WHISPER_API_BASE)
+elif not WHISPER_LOCAL_MODEL:
+    logger.warning("OPENAI_API_KEY / WHISPER_API_BASE / WHISPER_LOCAL_MODEL missing. Voice transcription disabled.")
+
+# Local faster-whisper backend (optional dependency, only needed with WHISPER_LOCAL_MODEL).
+# Its bundled Silero VAD also screens out silent voice notes before they reach the API.
+try:
+    from faster_whisper import WhisperModel
+    from faster_whisper.audio import decode_audio
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+except ImportError:
+    WhisperModel = None
+    if WHISPER_LOCAL_MODEL: logger.warning("WHISPER_LOCAL_MODEL set but faster-whisper is not installed (see requirements-local-whisper.txt).")
+# 500 ms of silence ends a speech segment; silent stretches are never sent to Whisper
+VAD_MIN_SILENCE_MS = 500
+
+# Redis (optional dependency, only needed with REDIS_URL)
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+    if REDIS_URL: logger.warning("REDIS_URL set but redis is not installed (see requirements-redis.txt). Conversation state stays in memory.")
+
 # --- Mailgun Configuration Check ---
 mailgun_configured = bool(MAILGUN_API_KEY and MAILGUN_DOMAIN and MAILGUN_FROM_EMAIL)
 if not mailgun_configured:
     logger.warning("Mailgun API Key, Domain, or From Email missing. Email sending disabled.")
 
 
+# --- Intent Parsing ---
+# Outermost {...} span of the model reply; tolerates markdown fences or chatter around the JSON
+_JSON_RE = re.compile(rb"\{.*\}", re.DOTALL)
+
+# Refined prompt for clarity and robustness; only {text} changes per message
+INTENT_PROMPT_TMPL = """[INST] Your task is to analyze the user's request below and classify it into one of the predefined intents. Extract relevant parameters for that intent. Respond ONLY with a valid JSON object containing 'intent' and 'params'.
+
+Possible Intents:
+- 'ANSWER_QUESTION': General question about tasks. Params: {{}}
+- 'CREATE_TASK': Create a new task. Params: 'name' (required, string), 'description' (optional, string).
+- 'ADD_CONTEXT': Add a message/note to an existing task. Params: 'task_query' (task name or keywords, required, string), 'content' (message to add, required, string).
+- 'SET_DEADLINE': Set a task deadline. Params: 'task_query' (task name or keywords, required, string), 'deadline' (date string, required, YYYY-MM-DD preferred but return original string if ambiguous like 'tomorrow').
+- 'UNKNOWN': Intent unclear or not task-related. Params: {{}}
+
+User Request: "{text}"
+
+JSON Response: [/INST]""" # Using instruction format common for some models
+
+# Reply prompts, formatted once per message. The per-user context sits ahead of the
+# user's text so Ollama can reuse its cached prefix across a user's questions.
+ANSWER_PROMPT_TMPL = "System: You are a helpful assistant answering questions based ONLY on the provided task context.\nContext:\n---\n{context}\n---\nUser: {text}\nAnswer:"
+CHAT_PROMPT_TMPL = "System: You are a helpful assistant. The user said '{text}', which wasn't a specific command. Respond helpfully based on their tasks if relevant, or have a brief general chat.\nContext:\n---\n{context}\n---\nResponse:"
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# --- Task Lookup ---
+# Trigram similarity above which the best of several candidate tasks is taken as the match
+TASK_MATCH_MIN_SCORE = 0.55
+
+# Deadline updates queued while a write is in flight go out together in the next one
+_deadline_batch: list[tuple[date, int, str, asyncio.Future]] = []
+_deadline_flush: asyncio.Task | None = None
+
+# --- Message Filters ---
+# Composed once and shared by the conversation states and the generic text handler
+TEXT_NO_CMD = filters.TEXT & ~filters.COMMAND
+
 # --- Conversation Handler States ---
-ASK_EMAIL, ASK_CODE = range(2)
+class LinkState(IntEnum):
+    ASK_EMAIL = 0
+    ASK_CODE = 1
+
+# Seconds an idle /link conversation lives (also the TTL of its persisted state)
+CONV_TIMEOUT_S: Final[float] = 300.0
 
 # --- Helper Functions ---
 
 # --- Linking Helpers ---
 async def get_profile_by_telegram_id(telegram_id: int) -> dict | None:
-    """Fetches profile using telegram_id."""
-    if not supabase: return None
+    """Fetches profile using telegram_id (served from the TTL cache when warm)."""
+    if not DB_POOL: return None
+    profile = _profile_cache.get(telegram_id)
+    if profile: return profile
     try:
         # Select id (Supabase UUID) and email for confirmation message
-        res = supabase.table("profiles").select("id, telegram_id, email").eq("telegram_id", telegram_id).limit(1).execute()
-        return res.data[0] if res.data else None
+        row = await DB_POOL.fetchrow("SELECT id, telegram_id, email FROM profiles WHERE telegram_id = $1 LIMIT 1", telegram_id)
+        if not row: return None # Not cached, so a fresh link shows up immediately
+        profile = _profile_cache[telegram_id] = dict(row, id=str(row['id']))
+        return profile
     except Exception as e:
-        logger.error(f"Error fetching profile by telegram_id {telegram_id}: {e}", exc_info=True)
+        logger.error("Error fetching profile by telegram_id %s: %s", telegram_id, e, exc_info=True)
         return None
 
+def evict_cached_profile(supabase_user_uuid: str) -> None:
+    """Drops every cached telegram_id entry that maps to this profile, e.g. after it is re-linked."""
+    for telegram_id in [tid for tid, profile in _profile_cache.items() if profile['id'] == supabase_user_uuid]:
+        _profile_cache.pop(telegram_id, None)
+
 async def get_user_uuid_by_email(email: str) -> str | None:
     """Finds Supabase user UUID by looking up the email in the public.profiles table."""
-    if not supabase: return None
+    if not DB_POOL: return None
     try:
         # Query the public.profiles table (no schema needed)
         # Match email case-insensitively
-        res = supabase.table("profiles").select("id").ilike("email", email.strip().lower()).limit(1).execute() # Use ilike for case-insensitive
+        # lower(email) matches the profiles_email_lower_idx functional index
+        user_uuid = await DB_POOL.fetchval("SELECT id FROM profiles WHERE lower(email) = lower($1) LIMIT 1", email.strip())
 
-        if res.data:
-            logger.info(f"Found profile via email {email}: {res.data[0]['id']}")
-            return res.data[0]['id'] # The 'id' column IS the Supabase User UUID
+        if user_uuid:
+            logger.info("Found profile via email %s: %s", email, user_uuid)
+            return str(user_uuid) # The 'id' column IS the Supabase User UUID
         else:
-            logger.warning(f"Could not find profile for email {email}.")
+            logger.warning("Could not find profile for email %s.", email)
             return None
     except Exception as e:
-        logger.error(f"Error fetching profile UUID by email {email}: {e}", exc_info=True)
+        logger.error("Error fetching profile UUID by email %s: %s", email, e, exc_info=True)
         return None
 
 
 async def store_link_code(supabase_user_uuid: str, telegram_id: int, code: str) -> bool:
     """Stores the link code and expiry in the user's profile using upsert."""
-    if not supabase: return False
+    if not DB_POOL: return False
     try:
         expires_at = datetime.now(timezone.utc) + timedelta(minutes=10) # 10 minute expiry
-        # Upsert ensures profile row exists or updates existing one
-        # It matches on 'id' (PK) and updates the other fields
-        res = supabase.table("profiles").upsert({
-            "id": supabase_user_uuid, # Match on primary key
-            "link_code": code,
-            "link_code_expires_at": expires_at.isoformat(),
-            "telegram_id": None # Clear previous link during new link process for THIS user
-        }, on_conflict="id").execute() # Conflict on the user UUID (PK)
-
-        if res.data:
-             logger.info(f"Stored/Updated link code for Supabase user {supabase_user_uuid}")
-             # Also clear the code from any *other* user who might have had this telegram_id pending
-             # This prevents linking wrong account if user starts linking with two emails/accounts
-             # for the same telegram ID before completing one.
-             supabase.table("profiles").update({
-                 "link_code": None,
-                 "link_code_expires_at": None
-             }).eq("telegram_id", telegram_id).neq("id", supabase_user_uuid).execute()
-             return True
-        else:
-             # Upsert in v1 might not return data on success consistently, check for errors instead
-             # A lack of data might also mean the profile didn't exist and upsert couldn't insert? Check DB schema.
-             # Let's assume for now lack of error means success. Need testing.
-             logger.warning(f"Upsert for link code might have failed or returned no data for Supabase user {supabase_user_uuid}.")
-             # Let's assume success if no explicit error was raised by the client library
-             # Revisit this if linking fails consistently.
-             return True # Tentative: Assume success if no exception
+        # Single round trip: the CTE upserts this user's row (matching on 'id' PK, clearing
+        # telegram_id so the previous link is dropped during the new link process for THIS user),
+        # and the outer UPDATE clears the code from any *other* user who might have had this
+        # telegram_id pending. This prevents linking wrong account if user starts linking with
+        # two emails/accounts for the same telegram ID before completing one.
+        await DB_POOL.execute(
+            "WITH up AS ("
+            " INSERT INTO profiles (id, link_code, link_code_expires_at, telegram_id) VALUES ($1, $2, $3, NULL)"
+            " ON CONFLICT (id) DO UPDATE SET link_code = EXCLUDED.link_code,"
+            " link_code_expires_at = EXCLUDED.link_code_expires_at, telegram_id = NULL"
+            " RETURNING id"
+            ") UPDATE profiles SET link_code = NULL, link_code_expires_at = NULL WHERE telegram_id = $4 AND id <> $1",
+            supabase_user_uuid, code, expires_at, telegram_id
+        )
+        evict_cached_profile(supabase_user_uuid) # Its previous Telegram account was just unlinked
+        logger.info("Stored/Updated link code for Supabase user %s", supabase_user_uuid)
+        return True
     except Exception as e:
-        logger.error(f"Error storing link code for user {supabase_user_uuid}: {e}", exc_info=True)
+        logger.error("Error storing link code for user %s: %s", supabase_user_uuid, e, exc_info=True)
         return False
 
 async def verify_link_code(telegram_id: int, code_attempt: str) -> str | None:
     """Verifies code, links account if valid, returns Supabase UUID or 'ALREADY_LINKED_OTHER' or None."""
-    if not supabase: return None
+    if not DB_POOL: return None
     try:
-        # Find profile by the CODE
-        res = supabase.table("profiles").select("id, link_code_expires_at, telegram_id").eq("link_code", code_attempt).limit(1).execute()
-
-        if not res.data:
-            logger.warning(f"Link code attempt failed for telegram_id {telegram_id}: Code '{code_attempt}' not found.")
+        # Common path is one atomic statement: expiry is enforced server-side and the target
+        # profile must be either not linked or linked to current telegram user (no check/update race).
+        # link_code isn't unique (6 digits), so lock and link exactly one matching profile.
+        supabase_user_uuid = await DB_POOL.fetchval(
+            "UPDATE profiles SET telegram_id = $1, link_code = NULL, link_code_expires_at = NULL "
+            "WHERE id = (SELECT id FROM profiles WHERE link_code = $2 AND link_code_expires_at > now() "
+            "AND (telegram_id IS NULL OR telegram_id = $1) LIMIT 1 FOR UPDATE) "
+            "RETURNING id",
+            telegram_id, code_attempt
+        )
+        if supabase_user_uuid:
+            _profile_cache.pop(telegram_id, None)
+            evict_cached_profile(str(supabase_user_uuid))
+            logger.info("Successfully linked Telegram ID %s to Supabase User %s", telegram_id, supabase_user_uuid)
+            return str(supabase_user_uuid)
+
+        # Failed: look the code up once more to report why
+        profile = await DB_POOL.fetchrow("SELECT id, telegram_id FROM profiles WHERE link_code = $1 LIMIT 1", code_attempt)
+        if not profile:
+            logger.warning("Link code attempt failed for telegram_id %s: Code '%s' not found.", telegram_id, code_attempt)
             return None
 
-        profile = res.data[0]
-        supabase_user_uuid = profile['id']
-        expires_at_str = profile['link_code_expires_at']
-        current_linked_telegram_id = profile.get('telegram_id') # Get currently linked ID for this profile
-
         # Check if the profile found via code is already linked to a *different* Telegram ID
+        current_linked_telegram_id = profile['telegram_id']
         if current_linked_telegram_id and current_linked_telegram_id != telegram_id:
-             logger.warning(f"Code {code_attempt} belongs to user {supabase_user_uuid} but they are already linked to Telegram ID {current_linked_telegram_id}.")
+             logger.warning("Code %s belongs to user %s but they are already linked to Telegram ID %s.", code_attempt, profile['id'], current_linked_telegram_id)
              # Don't clear the code here, the other user might still need it? Or maybe clear it? Risky.
              # Best to just report the error.
              return "ALREADY_LINKED_OTHER" # Indicate the target Supabase account is linked elsewhere
 
-        # Check expiry
-        if not expires_at_str or isoparse(expires_at_str) < datetime.now(timezone.utc):
-            logger.warning(f"Link code attempt failed for telegram_id {telegram_id}: Code expired.")
-            # Clear expired code
-            supabase.table("profiles").update({"link_code": None, "link_code_expires_at": None}).eq("id", supabase_user_uuid).eq("link_code", code_attempt).execute()
-            return None
-
-        # Code is valid, not expired, and target profile is either not linked or linked to current telegram user
-        # Proceed to link
-        update_res = supabase.table("profiles").update({
-            "telegram_id": telegram_id,
-            "link_code": None,
-            "link_code_expires_at": None
-        }).eq("id", supabase_user_uuid).execute()
-
-        if update_res.data:
-            logger.info(f"Successfully linked Telegram ID {telegram_id} to Supabase User {supabase_user_uuid}")
-            return supabase_user_uuid
-        else:
-            logger.error(f"Failed to update profile during final link step for Telegram ID {telegram_id} to Supabase User {supabase_user_uuid}")
-            # This would be an unexpected DB error
-            return None
+        logger.warning("Link code attempt failed for telegram_id %s: Code expired.", telegram_id)
+        # Clear expired code
+        await DB_POOL.execute("UPDATE profiles SET link_code = NULL, link_code_expires_at = NULL WHERE id = $1 AND link_code = $2", profile['id'], code_attempt)
+        return None
 
     except Exception as e:
-        logger.error(f"Error verifying link code for telegram_id {telegram_id}: {e}", exc_info=True)
+        logger.error("Error verifying link code for telegram_id %s: %s", telegram_id, e, exc_info=True)
         return None
 
 def generate_link_code(length=6):
-    """Generates a random numeric code."""
-    return "".join(random.choices(string.digits, k=length))
+    """Generates a cryptographically secure random numeric code."""
+    return f"{secrets.randbelow(10**length):0{length}d}"
 
 async def send_link_code_email(to_email: str, code: str) -> bool:
-    """Sends the linking code via Mailgun using requests."""
+    """Sends the linking code via Mailgun using the shared async HTTP client."""
     if not mailgun_configured:
          logger.error('Mailgun not configured for sending link code.')
          return False
 
-    logger.info(f"Attempting to send link code email to {to_email} via Mailgun.")
+    logger.info("Attempting to send link code email to %s via Mailgun.", to_email)
     subject = "Your LiquidLM Telegram Bot Linking Code"
     htmlBody = f"""
     <p>Hello,</p>
@@ -215,20 +343,20 @@ async def send_link_code_email(to_email: str, code: str) -> bool:
     <p>Thanks,<br/>The LiquidLM Team</p>
     """
     api_endpoint = f"{MAILGUN_API_BASE_URL}/{MAILGUN_DOMAIN}/messages"
-    auth_tuple = ("api", MAILGUN_API_KEY)
+    auth = httpx.BasicAuth("api", MAILGUN_API_KEY)
     data = { "from": MAILGUN_FROM_EMAIL, "to": [to_email], "subject": subject, "html": htmlBody }
 
     try:
-        response = requests.post(api_endpoint, auth=auth_tuple, data=data, timeout=20) # Increased timeout slightly
+        response = await HTTP.post(api_endpoint, auth=auth, data=data, timeout=20) # Increased timeout slightly
         response.raise_for_status()
-        logger.info(f"Link code email sent via Mailgun to {to_email}. Status: {response.status_code}, ID: {response.json().get('id')}")
+        logger.info("Link code email sent via Mailgun to %s. Status: %s, ID: %s", to_email, response.status_code, response.json().get('id'))
         return True
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Mailgun API request failed for {to_email}: {e}", exc_info=False) # Keep log concise
-        if e.response is not None: logger.error(f"Mailgun error response: {e.response.text}")
+    except httpx.HTTPError as e:
+        logger.error("Mailgun API request failed for %s: %s", to_email, e, exc_info=False) # Keep log concise
+        if isinstance(e, httpx.HTTPStatusError): logger.error("Mailgun error response: %s", e.response.text)
         return False
     except Exception as e:
-         logger.error(f"Unexpected error during Mailgun request for {to_email}: {e}", exc_info=True)
+         logger.error("Unexpected error during Mailgun request for %s: %s", to_email, e, exc_info=True)
          return False
 
 # --- Central Auth Check ---
@@ -241,176 +369,307 @@ async def get_supabase_uuid(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     profile = await get_profile_by_telegram_id(telegram_id)
     if profile and profile.get('id'):
-        logger.debug(f"User {telegram_id} is linked to Supabase ID {profile['id']}")
+        logger.debug("User %s is linked to Supabase ID %s", telegram_id, profile['id'])
         return profile['id'] # Return the Supabase UUID
     else:
-        logger.info(f"User {telegram_id} is not linked. Prompting.")
+        logger.info("User %s is not linked. Prompting.", telegram_id)
         # Avoid sending message if the original update wasn't a message (e.g., callback query)
         if update.message:
             await update.message.reply_text("Your Telegram account isn't linked to LiquidLM yet. Please use /link first.")
         return None
 
 # --- Core Logic Helpers ---
-async def transcribe_audio(audio_file_path: str) -> str | None:
-    """Transcribes audio using Whisper."""
-    logger.info(f"Transcribing audio file: {audio_file_path}")
-    # Check if Whisper is configured (example)
-    # if not openai.api_key and not openai.api_base:
-    #     logger.error("Whisper Error: OpenAI API Key or Base URL not configured.")
-    #     return None # Or implement local library call
+@functools.cache
+def _get_whisper_model() -> "WhisperModel":
+    """Loads the local faster-whisper model once; later calls reuse it."""
+    import ctranslate2 # faster-whisper's inference engine
+    device = WHISPER_DEVICE
+    if device == "auto": device = "cuda" if ctranslate2.get_cuda_device_count() else "cpu"
+    # int8 weights roughly halve memory traffic and speed up the encoder with little accuracy loss
+    compute_type = WHISPER_COMPUTE_TYPE or ("int8_float16" if device == "cuda" else "int8")
+    logger.info("Loading local Whisper model '%s' on %s (%s)", WHISPER_LOCAL_MODEL, device, compute_type)
+    return WhisperModel(WHISPER_LOCAL_MODEL, device=device, compute_type=compute_type)
+
+def _transcribe_local(audio_bytes: bytes) -> str:
+    """Runs faster-whisper on in-memory audio. Blocking, so call it via asyncio.to_thread."""
+    # Segments are a generator: decoding proceeds window by window as they're consumed
+    # vad_filter drops non-speech audio up front; a silent note yields no segments and skips decoding
+    segments, _info = _get_whisper_model().transcribe(
+        BytesIO(audio_bytes), vad_filter=True, vad_parameters={"min_silence_duration_ms": VAD_MIN_SILENCE_MS}
+    )
+    return "".join(segment.text for segment in segments).strip()
 
+def _warm_up_whisper() -> None:
+    """Loads the local model and decodes 1 s of silence so the first voice note skips model load/device init."""
+    import numpy as np # Ships with faster-whisper
+    segments, _info = _get_whisper_model().transcribe(np.zeros(16_000, dtype=np.float32), language="en")
+    for _ in segments: pass # Consume the generator so decoding actually runs
+
+def _has_speech(audio_bytes: bytes) -> bool:
+    """Decodes audio to 16 kHz PCM and runs Silero VAD over it. Blocking, so call it via asyncio.to_thread.
+    Fails open: if decoding or the VAD model errors, assumes speech so the note still gets transcribed."""
     try:
-        with open(audio_file_path, "rb") as audio_file:
-            response = await openai.Audio.atranscribe("whisper-1", audio_file) # Requires openai v1+
-            transcription = response.text # Access the 'text' attribute directly in v1+
-            logger.info(f"Whisper Transcription successful: {transcription[:50]}...")
-            return transcription
+        audio = decode_audio(BytesIO(audio_bytes))
+        return bool(get_speech_timestamps(audio, VadOptions(min_silence_duration_ms=VAD_MIN_SILENCE_MS)))
     except Exception as e:
-        logger.error(f"Error during Whisper transcription: {e}", exc_info=True)
+        logger.warning("Speech detection failed, transcribing anyway: %s", e)
+        return True
+
+async def transcribe_audio(audio_bytes: bytes) -> str | None:
+    """Transcribes in-memory audio using Whisper (local faster-whisper model if configured, else the API).
+    Returns "" when the audio holds no speech, None on error."""
+    logger.info("Transcribing audio (%d bytes)", len(audio_bytes))
+    try:
+        if WHISPER_LOCAL_MODEL and WhisperModel:
+            transcription = await asyncio.to_thread(_transcribe_local, audio_bytes)
+        elif whisper_client:
+            if WhisperModel and not await asyncio.to_thread(_has_speech, audio_bytes):
+                logger.info("No speech detected; skipping the Whisper API call")
+                return ""
+            response = await whisper_client.audio.transcriptions.create(
+                model="whisper-1", file=("voice.ogg", audio_bytes)
+            )
+            transcription = response.text
+        else:
+            logger.error("Whisper Error: no local model or OpenAI API Key/Base URL configured.")
+            return None
+        logger.info("Whisper Transcription successful: %s...", transcription[:50])
+        return transcription
+    except Exception as e:
+        logger.error("Error during Whisper transcription: %s", e, exc_info=True)
         return None
-    finally:
-        if os.path.exists(audio_file_path):
-            try:
-                os.remove(audio_file_path)
-                logger.info(f"Cleaned up audio file: {audio_file_path}")
-            except OSError as e:
-                logger.error(f"Error removing audio file {audio_file_path}: {e}")
+
+def invalidate_task_context(user_uuid: str) -> None:
+    """Drops the cached task context for a user after one of the bot's writes."""
+    _ctx_cache.pop(user_uuid, None)
 
 async def fetch_task_context(user_uuid: str) -> str:
-    """Fetches task list, descriptions for context."""
-    if not supabase or not user_uuid: return "Error: DB connection/User ID missing."
+    """Fetches task list, descriptions for context (served from the TTL cache when warm)."""
+    if not DB_POOL or not user_uuid: return "Error: DB connection/User ID missing."
+    cached = _ctx_cache.get(user_uuid)
+    if cached: return cached
 
     context_items = []
     context_items.append("## Your Current Tasks:")
     try:
-        # Fetch non-done tasks first, then done ones? Or just recent? Limit total.
-        tasks_res = supabase.table('tasks').select('id, name, description, status, deadline, tags') \
-                      .eq('user_id', user_uuid) \
-                      .order('status', desc=False) \
-                      .order('sort_order', nullsfirst=True) \
-                      .order('created_at', desc=True) \
-                      .limit(30).execute()
-
-        if tasks_res.data:
-            for task in tasks_res.data:
-                task_str = f"- Task ID: {task['id']}, Name: {task['name']}, Status: {task['status']}"
-                if task.get('deadline'): task_str += f", Deadline: {task['deadline']}"
-                if task.get('tags'): task_str += f", Tags: {', '.join(task['tags'])}"
-                if task.get('description'): task_str += f"\n  Description: {task['description'][:150].strip()}..."
+        # Only the top rows by status, then newest first (tasks has no updated_at), ever reach the prompt
+        tasks = await DB_POOL.fetch(
+            "SELECT id, name, description, status, deadline, tags FROM tasks WHERE user_id = $1 "
+            "ORDER BY status ASC, sort_order ASC NULLS FIRST, created_at DESC LIMIT $2",
+            user_uuid, TASK_CONTEXT_LIMIT
+        )
+
+        # Stop adding tasks once the length budget is spent instead of formatting rows we'd cut off
+        max_len = TASK_CONTEXT_MAX_CHARS # Adjust based on model context window
+        budget = max_len - len(context_items[0])
+        if tasks:
+            for task in tasks:
+                deadline = f", Deadline: {task['deadline']}" if task['deadline'] else ""
+                tags = f", Tags: {', '.join(task['tags'])}" if task['tags'] else ""
+                desc = f"\n  Description: {task['description'][:150].strip()}..." if task['description'] else ""
+                task_str = f"- Task ID: {task['id']}, Name: {task['name']}, Status: {task['status']}{deadline}{tags}{desc}"
+                budget -= len(task_str) + 1 # +1 for the joining newline
+                if budget < 0:
+                    logger.warning("Context for user %s exceeded limit %s. Truncating.", user_uuid, max_len)
+                    context_items.append("... (context truncated)")
+                    break
                 context_items.append(task_str)
         else:
             context_items.append("- You have no tasks.")
 
         full_context = "\n".join(context_items)
-        logger.info(f"Fetched context for user {user_uuid}, length {len(full_context)}")
-        # Simple truncation if needed
-        max_len = 3800 # Adjust based on model context window
-        if len(full_context) > max_len:
-            logger.warning(f"Context length ({len(full_context)}) exceeded limit {max_len}. Truncating.")
-            full_context = full_context[:max_len] + "\n... (context truncated)"
+        logger.info("Fetched context for user %s, length %d", user_uuid, len(full_context))
+        _ctx_cache[user_uuid] = full_context
         return full_context
 
     except Exception as e:
-        logger.error(f"Error fetching task context for user {user_uuid}: {e}", exc_info=True)
+        logger.error("Error fetching task context for user %s: %s", user_uuid, e, exc_info=True)
         return "Error: Could not fetch task context."
 
+def _ollama_payload(prompt: str, stream: bool) -> bytes:
+    """Serializes an /api/generate request body straight to UTF-8 JSON bytes."""
+    payload = {"model": OLLAMA_MODEL, "prompt": prompt, "stream": stream}
+    if OLLAMA_KEEP_ALIVE: payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+    return orjson.dumps(payload)
+
 async def get_ollama_response(prompt: str) -> str:
     """Gets a response from the local Ollama model."""
-    logger.info(f"Sending prompt to Ollama ({OLLAMA_MODEL}). Length: {len(prompt)}")
-    api_url = f"{OLLAMA_BASE_URL}/api/generate"
-    payload = { "model": OLLAMA_MODEL, "prompt": prompt, "stream": False }
+    logger.info("Sending prompt to Ollama (%s). Length: %d", OLLAMA_MODEL, len(prompt))
+    payload = _ollama_payload(prompt, stream=False)
     try:
-        response = requests.post(api_url, json=payload, timeout=180)
+        async with _ollama_sem:
+            response = await OLLAMA_HTTP.post("/api/generate", content=payload, headers=_JSON_HEADERS)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content) # Parse raw bytes directly, skipping the str decode
         response_text = data.get('response', '').strip()
-        logger.info(f"Received response from Ollama. Length: {len(response_text)}")
+        logger.info("Received response from Ollama. Length: %d", len(response_text))
         if not response_text:
              logger.warning("Ollama returned an empty response.")
              return "Sorry, I received an empty response from the AI model."
         return response_text
-    except requests.exceptions.Timeout:
-         logger.error(f"Timeout error communicating with Ollama at {api_url}")
+    except httpx.TimeoutException:
+         logger.error("Timeout error communicating with Ollama at %s", OLLAMA_BASE_URL)
          return "Error: The AI model took too long to respond."
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error communicating with Ollama: {e}", exc_info=True)
+    except httpx.HTTPError as e:
+        logger.error("Error communicating with Ollama: %s", e) # Network failure, traceback adds nothing
         return f"Error: Could not connect to the Ollama AI model ({OLLAMA_BASE_URL})."
     except Exception as e:
-        logger.error(f"Error processing Ollama response: {e}", exc_info=True)
+        logger.error("Error processing Ollama response: %s", e, exc_info=True)
         return "Error: Could not process the AI model's response."
 
+async def stream_ollama_response(prompt: str, message: Message) -> str:
+    """Streams a response from Ollama into a reply to `message`, editing it as tokens arrive."""
+    logger.info("Streaming prompt to Ollama (%s). Length: %d", OLLAMA_MODEL, len(prompt))
+    payload = _ollama_payload(prompt, stream=True)
+    reply = await message.reply_text("💭 Thinking...")
+    parts: list[str] = []
+    shown = ""
+    last_edit = time.monotonic()
+    try:
+        async with _ollama_sem:
+            async with OLLAMA_HTTP.stream("POST", "/api/generate", content=payload, headers=_JSON_HEADERS) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line: continue
+                    chunk = orjson.loads(line)
+                    parts.append(chunk.get('response', ''))
+                    if chunk.get('done'): break
+                    if time.monotonic() - last_edit < STREAM_EDIT_INTERVAL: continue
+                    partial = "".join(parts).strip()[:MessageLimit.MAX_TEXT_LENGTH]
+                    if partial and partial != shown:
+                        try:
+                            await reply.edit_text(partial)
+                            shown = partial
+                        except TelegramError as e: # Don't abort the stream over a failed interim edit
+                            logger.warning("Interim edit of streamed reply failed: %s", e)
+                        last_edit = time.monotonic()
+        response_text = "".join(parts).strip()
+        logger.info("Received streamed response from Ollama. Length: %d", len(response_text))
+        if not response_text:
+             logger.warning("Ollama returned an empty response.")
+             response_text = "Sorry, I received an empty response from the AI model."
+    except httpx.TimeoutException:
+         logger.error("Timeout error communicating with Ollama at %s", OLLAMA_BASE_URL)
+         response_text = "Error: The AI model took too long to respond."
+    except httpx.HTTPError as e:
+        logger.error("Error communicating with Ollama: %s", e) # Network failure, traceback adds nothing
+        response_text = f"Error: Could not connect to the Ollama AI model ({OLLAMA_BASE_URL})."
+    except Exception as e:
+        logger.error("Error processing Ollama stream: %s", e, exc_info=True)
+        response_text = "Error: Could not process the AI model's response."
+
+    # A single message can't exceed Telegram's text limit; show the head of very long answers
+    final_text = response_text[:MessageLimit.MAX_TEXT_LENGTH]
+    if final_text != shown:
+        try: await reply.edit_text(final_text)
+        except TelegramError as e: # Most likely flood control after a long stream; the answer itself is fine
+            logger.warning("Final edit of streamed reply failed (%s). Sending it as a new message.", e)
+            if isinstance(e, RetryAfter): await asyncio.sleep(e.retry_after)
+            try: await message.reply_text(final_text)
+            except TelegramError as e: logger.error("Could not deliver streamed reply: %s", e)
+    return response_text
+
 async def determine_intent_and_params(text: str) -> dict:
     """Uses Ollama to determine intent and extract parameters."""
-    # Refined prompt for clarity and robustness
-    prompt = f"""[INST] Your task is to analyze the user's request below and classify it into one of the predefined intents. Extract relevant parameters for that intent. Respond ONLY with a valid JSON object containing 'intent' and 'params'.
-
-Possible Intents:
-- 'ANSWER_QUESTION': General question about tasks. Params: {{}}
-- 'CREATE_TASK': Create a new task. Params: 'name' (required, string), 'description' (optional, string).
-- 'ADD_CONTEXT': Add a message/note to an existing task. Params: 'task_query' (task name or keywords, required, string), 'content' (message to add, required, string).
-- 'SET_DEADLINE': Set a task deadline. Params: 'task_query' (task name or keywords, required, string), 'deadline' (date string, required, YYYY-MM-DD preferred but return original string if ambiguous like 'tomorrow').
-- 'UNKNOWN': Intent unclear or not task-related. Params: {{}}
-
-User Request: "{text}"
-
-JSON Response: [/INST]""" # Using instruction format common for some models
+    prompt = INTENT_PROMPT_TMPL.format_map({"text": text})
 
     response_text = await get_ollama_response(prompt)
     try:
-        # Attempt to parse directly, assuming LLM follows instructions
-        result = json.loads(response_text)
-        if isinstance(result, dict) and 'intent' in result and 'params' in result:
-             logger.info(f"Determined Intent: {result.get('intent')}, Params: {result.get('params')}")
+        # Extract the JSON object in one pass instead of guessing at LLM artifacts
+        match = _JSON_RE.search(response_text.encode())
+        if not match: raise ValueError("No JSON object in response")
+        result = orjson.loads(match.group(0))
+        if isinstance(result, dict) and result.keys() >= {"intent", "params"}:
+             logger.info("Determined Intent: %s, Params: %s", result.get('intent'), result.get('params'))
              return result
-        else:
-            raise ValueError("Invalid JSON structure")
-    except json.JSONDecodeError:
-        logger.error(f"Failed to decode JSON from Ollama intent response: {response_text}")
-        # Fallback: Try cleaning common LLM artifacts (like markdown) and retry
-        if response_text.strip().startswith("```json"):
-             cleaned_response = response_text.strip("```json \n")
-        elif response_text.strip().startswith("{") and response_text.strip().endswith("}"):
-             cleaned_response = response_text.strip() # Assume it's just JSON
-        else:
-             cleaned_response = response_text # No obvious artifact
-
-        try:
-            result = json.loads(cleaned_response)
-            if isinstance(result, dict) and 'intent' in result and 'params' in result:
-                logger.info(f"Determined Intent (after cleaning): {result.get('intent')}, Params: {result.get('params')}")
-                return result
-            else:
-                 raise ValueError("Invalid JSON structure after cleaning")
-        except Exception as e:
-            logger.error(f"Error parsing Ollama intent JSON even after cleaning: {e}\nCleaned response: {cleaned_response}", exc_info=False)
-            return {"intent": "UNKNOWN", "params": {}}
+        raise ValueError("Invalid JSON structure")
+    except ValueError as e: # orjson.JSONDecodeError is a ValueError
+        logger.error("Failed to parse intent JSON from Ollama response: %s\nResponse: %s", e, response_text)
+        return {"intent": "UNKNOWN", "params": {}}
     except Exception as e: # Catch other potential errors
-         logger.error(f"Unexpected error during intent parsing: {e}", exc_info=True)
+         logger.error("Unexpected error during intent parsing: %s", e, exc_info=True)
          return {"intent": "UNKNOWN", "params": {}}
 
 
 async def find_task_id(user_uuid: str, task_query: str) -> int | None:
-    """Finds a task ID based on name query (case-insensitive)."""
-    if not supabase or not user_uuid or not task_query: return None
-    logger.info(f"Searching for task matching query: '{task_query}' for user {user_uuid}")
+    """Finds a task ID based on name query (case-insensitive substring or trigram similarity)."""
+    if not DB_POOL or not user_uuid or not task_query: return None
+    logger.info("Searching for task matching query: '%s' for user %s", task_query, user_uuid)
     try:
-        res = supabase.table('tasks').select('id').eq('user_id', user_uuid).ilike('name', f'%{task_query}%').limit(5).execute() # Use simple LIKE match
-        if len(res.data) == 1:
-            task_id = res.data[0]['id']
-            logger.info(f"Found unique task by name LIKE match. ID: {task_id}")
+        # Both predicates are served by the tasks_name_trgm GIN index (see migrations/)
+        rows = await DB_POOL.fetch(
+            "SELECT id, similarity(name, $2) AS score, name ILIKE '%' || $2 || '%' AS substring_match FROM tasks "
+            "WHERE user_id = $1 AND (name ILIKE '%' || $2 || '%' OR name % $2) "
+            "ORDER BY substring_match DESC, score DESC LIMIT 5",
+            user_uuid, task_query
+        )
+        # A task whose name contains the query wins outright if it's the only one; fuzzy-only hits
+        # (the % operator passes at ~0.3 similarity) are used only when nothing contains the query,
+        # and then only if the best one clears TASK_MATCH_MIN_SCORE
+        substring_rows = [row for row in rows if row['substring_match']]
+        match = None
+        if len(substring_rows) == 1: match = substring_rows[0]
+        elif not substring_rows and rows and rows[0]['score'] > TASK_MATCH_MIN_SCORE: match = rows[0]
+        if match:
+            task_id = match['id']
+            logger.info("Found task by name match. ID: %s, score: %.2f", task_id, match['score'])
             return task_id
-        elif len(res.data) > 1:
-             logger.warning(f"Found multiple tasks matching query '{task_query}'. Needs clarification.")
+        elif rows:
+             logger.warning("Found %d task(s) matching query '%s' with no clear best match. Needs clarification.", len(rows), task_query)
              # TODO: Ask user to clarify which task ID or use LLM to pick best match?
              return None # Indicate ambiguity
         else:
-            logger.warning(f"Could not find task matching query: '{task_query}' by name LIKE match.")
+            logger.warning("Could not find task matching query: '%s' by name match.", task_query)
             # TODO: Optionally search description?
             return None
     except Exception as e:
-        logger.error(f"Error finding task ID for query '{task_query}': {e}", exc_info=True)
+        logger.error("Error finding task ID for query '%s': %s", task_query, e, exc_info=True)
         return None
 
+async def set_task_deadline(user_uuid: str, task_id: int, deadline: date) -> bool:
+    """Queues a deadline update and waits for its write; returns whether the task was updated (raises on DB error)."""
+    global _deadline_flush
+    done = asyncio.get_running_loop().create_future()
+    _deadline_batch.append((deadline, task_id, user_uuid, done))
+    if not _deadline_flush or _deadline_flush.done():
+        _deadline_flush = asyncio.create_task(_flush_deadline_batch())
+    return await done
+
+async def _write_deadlines(batch: list[tuple[date, int, str, asyncio.Future]]) -> set[int]:
+    """Applies a batch of deadline updates in one statement; returns the ids of the tasks updated."""
+    rows = await DB_POOL.fetch(
+        "UPDATE tasks t SET deadline = v.deadline "
+        "FROM unnest($1::date[], $2::bigint[], $3::uuid[]) AS v(deadline, id, user_id) "
+        "WHERE t.id = v.id AND t.user_id = v.user_id RETURNING t.id",
+        [deadline for deadline, _, _, _ in batch], [task_id for _, task_id, _, _ in batch], [uuid for _, _, uuid, _ in batch]
+    )
+    return {row['id'] for row in rows}
+
+async def _flush_deadline_batch() -> None:
+    """Writes queued deadline updates until none are left. No fixed delay: the first update goes out
+    at once, and updates that arrive meanwhile share the next statement."""
+    while _deadline_batch:
+        batch = _deadline_batch[:]
+        _deadline_batch.clear()
+        try:
+            updated = await _write_deadlines(batch)
+            if len(batch) > 1: logger.info("Wrote %d deadline update(s) in one statement", len(batch))
+            for _, task_id, _, done in batch:
+                if not done.done(): done.set_result(task_id in updated)
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][3].done(): batch[0][3].set_exception(e)
+                continue
+            # Retry singly so one failing row (e.g. a lock conflict with the web app) doesn't fail other users' updates
+            logger.warning("Batched deadline write failed (%s). Retrying %d updates one by one.", e, len(batch))
+            for item in batch:
+                done = item[3]
+                try: updated = await _write_deadlines([item])
+                except Exception as row_e:
+                    if not done.done(): done.set_exception(row_e)
+                    continue
+                if not done.done(): done.set_result(item[1] in updated)
+
 # --- Telegram Command Handlers ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -434,21 +693,21 @@ async def link_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the linking conversation, asks for email."""
     if not update.effective_user: return ConversationHandler.END
     telegram_id = update.effective_user.id
-    logger.info(f"Link process started by Telegram ID: {telegram_id}")
+    logger.info("Link process started by Telegram ID: %s", telegram_id)
     profile = await get_profile_by_telegram_id(telegram_id)
     if profile:
         await update.message.reply_text(f"Your account is already linked to {profile.get('email', 'an account')}.")
         return ConversationHandler.END
     await update.message.reply_text("Please enter the email address for your LiquidLM account:")
-    return ASK_EMAIL
+    return LinkState.ASK_EMAIL
 
 async def link_ask_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Receives email, sends code, asks for code."""
     if not update.effective_user or not update.message or not update.message.text: return ConversationHandler.END
     telegram_id = update.effective_user.id
     email = update.message.text.strip().lower()
-    logger.info(f"Received email '{email}' from Telegram ID: {telegram_id} for linking.")
-    if not supabase:
+    logger.info("Received email '%s' from Telegram ID: %s for linking.", email, telegram_id)
+    if not DB_POOL:
          await update.message.reply_text("Database error. Cannot link now.")
          return ConversationHandler.END
     supabase_user_uuid = await get_user_uuid_by_email(email)
@@ -463,18 +722,18 @@ async def link_ask_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     email_sent = await send_link_code_email(email, code)
     if not email_sent:
          await update.message.reply_text("Failed to send the verification code email. Check the email address and try /link again.")
-         supabase.table("profiles").update({"link_code": None, "link_code_expires_at": None}).eq("id", supabase_user_uuid).execute() # Clear failed attempt code
+         await DB_POOL.execute("UPDATE profiles SET link_code = NULL, link_code_expires_at = NULL WHERE id = $1", supabase_user_uuid) # Clear failed attempt code
          return ConversationHandler.END
     await update.message.reply_text(f"A 6-digit verification code has been sent to {email}. Please enter it here (it expires in 10 minutes):")
-    return ASK_CODE
+    return LinkState.ASK_CODE
 
 async def link_verify_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Receives code, verifies it, and links account."""
     if not update.effective_user or not update.message or not update.message.text: return ConversationHandler.END
     telegram_id = update.effective_user.id
     code_attempt = update.message.text.strip()
-    logger.info(f"Received code '{code_attempt}' from Telegram ID: {telegram_id} for verification.")
-    if not supabase:
+    logger.info("Received code '%s' from Telegram ID: %s for verification.", code_attempt, telegram_id)
+    if not DB_POOL:
          await update.message.reply_text("Database error. Cannot verify code.")
          return ConversationHandler.END
     linked_info = await verify_link_code(telegram_id, code_attempt)
@@ -489,7 +748,7 @@ async def link_verify_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def link_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels the linking conversation."""
     if not update.effective_user: return ConversationHandler.END
-    logger.info(f"Link process cancelled by user {update.effective_user.id}")
+    logger.info("Link process cancelled by user %s", update.effective_user.id)
     await update.message.reply_text("Account linking cancelled.")
     return ConversationHandler.END
 
@@ -497,16 +756,96 @@ async def unlink(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Unlinks the user's Telegram account."""
     if not update.effective_user: return
     telegram_id = update.effective_user.id
-    logger.info(f"Unlink requested by Telegram ID: {telegram_id}")
-    if not supabase: await update.message.reply_text("Database error."); return
+    logger.info("Unlink requested by Telegram ID: %s", telegram_id)
+    if not DB_POOL: await update.message.reply_text("Database error."); return
     try:
-        res = supabase.table("profiles").update({"telegram_id": None}).eq("telegram_id", telegram_id).execute()
-        if res.data: await update.message.reply_text("Your Telegram account has been unlinked.")
+        # Touches at most the one row found via profiles_telegram_id_idx
+        status = await DB_POOL.execute("UPDATE profiles SET telegram_id = NULL WHERE telegram_id = $1", telegram_id)
+        _profile_cache.pop(telegram_id, None)
+        if status != "UPDATE 0": await update.message.reply_text("Your Telegram account has been unlinked.")
         else: await update.message.reply_text("Your account wasn't linked or an error occurred.")
     except Exception as e:
-         logger.error(f"Error unlinking account for telegram_id {telegram_id}: {e}", exc_info=True)
+         logger.error("Error unlinking account for telegram_id %s: %s", telegram_id, e, exc_info=True)
          await update.message.reply_text("An error occurred while unlinking.")
 
+# --- Intent Handlers ---
+# Each takes (user_text, user_uuid, params, ctx_task, message) and returns the reply text,
+# or None when the reply was already streamed to the chat.
+
+async def _do_create_task(user_text: str, user_uuid: str, params: dict, ctx_task: asyncio.Task, message: Message) -> str | None:
+    task_name = params.get("name")
+    if not task_name: return "⚠️ Task name missing for creation."
+    task_desc = params.get("description")
+    res = await supabase.table("tasks").insert({
+        "user_id": user_uuid, "name": task_name, "description": task_desc, "status": "To do"
+    }).execute()
+    if not res.data:
+        logger.error("Task insert for user %s returned no rows", user_uuid); logger.debug("Task insert response: %s", res)
+        return "⚠️ DB Error creating task. Check logs."
+    invalidate_task_context(user_uuid)
+    return f"✅ Task created: '{task_name}'"
+
+async def _do_add_context(user_text: str, user_uuid: str, params: dict, ctx_task: asyncio.Task, message: Message) -> str | None:
+    task_query = params.get("task_query")
+    content = params.get("content")
+    if not (task_query and content): return "⚠️ Missing task query or note content."
+    task_id = await find_task_id(user_uuid, task_query)
+    if not task_id: return f"⚠️ Task matching '{task_query}' not found to add note."
+    res = await supabase.table("messages").insert({
+        "task_id": task_id, "user_id": None, "sender_email": "LiquidLM-Bot",
+        "content": content, "is_external": False # Mark as internal bot message maybe?
+    }).execute()
+    if not res.data:
+        logger.error("Msg insert for task %s returned no rows", task_id); logger.debug("Msg insert response: %s", res)
+        return "⚠️ DB Error adding note. Check logs."
+    invalidate_task_context(user_uuid)
+    return f"✅ Added note to task ID {task_id}."
+
+async def _do_set_deadline(user_text: str, user_uuid: str, params: dict, ctx_task: asyncio.Task, message: Message) -> str | None:
+    task_query = params.get("task_query")
+    deadline_str = params.get("deadline")
+    if not (task_query and deadline_str): return "⚠️ Missing task query or deadline."
+    try: # ISO date check via the C-implemented parser (formats back as YYYY-MM-DD).
+        # Keep any richer parsing here in plain Python/C libs; don't @njit string code.
+        valid_deadline = date.fromisoformat(deadline_str)
+    except (ValueError, TypeError):
+        logger.warning("Deadline '%s' not YYYY-MM-DD. Add parsing logic if needed.", deadline_str)
+        # TODO: Add robust date parsing here using dateparser library or similar if required
+        # For now, only accept YYYY-MM-DD
+        return f"⚠️ Could not parse deadline '{deadline_str}'. Please use YYYY-MM-DD format."
+    task_id = await find_task_id(user_uuid, task_query)
+    if not task_id: return f"⚠️ Task matching '{task_query}' not found to set deadline."
+    try: updated = await set_task_deadline(user_uuid, task_id, valid_deadline)
+    except Exception as e:
+        logger.error("Deadline update failed: %s", e)
+        return f"⚠️ DB Error setting deadline (Task ID: {task_id}). Check logs."
+    if not updated: # e.g. deleted from the web app since find_task_id
+        logger.error("Deadline update for task %s matched no row", task_id)
+        return f"⚠️ DB Error setting deadline (Task ID: {task_id}). Check logs."
+    invalidate_task_context(user_uuid)
+    return f"✅ Deadline set for task ID {task_id} to {valid_deadline}."
+
+async def _do_answer(user_text: str, user_uuid: str, params: dict, ctx_task: asyncio.Task, message: Message) -> str | None:
+    prompt = ANSWER_PROMPT_TMPL.format_map({"context": await ctx_task, "text": user_text})
+    await stream_ollama_response(prompt, message)
+    return None # Already delivered by streaming
+
+async def _do_unknown(user_text: str, user_uuid: str, params: dict, ctx_task: asyncio.Task, message: Message) -> str | None:
+    # Default fallback if intent is unclear
+    prompt = CHAT_PROMPT_TMPL.format_map({"context": await ctx_task, "text": user_text})
+    await stream_ollama_response(prompt, message)
+    return None # Already delivered by streaming
+    # return "Sorry, I couldn't determine a specific action. How can I help with your tasks?"
+
+INTENT_HANDLERS = {
+    "CREATE_TASK": _do_create_task,
+    "ADD_CONTEXT": _do_add_context,
+    "SET_DEADLINE": _do_set_deadline,
+    "ANSWER_QUESTION": _do_answer,
+}
+# Intents that write instead of reading the task context
+WRITE_INTENTS = frozenset({"CREATE_TASK", "ADD_CONTEXT", "SET_DEADLINE"})
+
 # --- Message Handlers ---
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -516,85 +855,29 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not supabase: await update.message.reply_text("Error: Database not connected."); return
 
     user_text = update.message.text
-    chat_id = update.message.chat_id
-    logger.info(f"Processing text from linked user {supabase_user_uuid}: {user_text[:50]}...")
-    await context.bot.send_chat_action(chat_id=chat_id, action='typing')
-
+    logger.info("Processing text from linked user %s: %s...", supabase_user_uuid, user_text[:50])
+    await context.bot.send_chat_action(chat_id=update.message.chat_id, action='typing')
+    await _process_user_text(user_text, update, context, supabase_user_uuid)
+
+async def _process_user_text(user_text: str, update: Update, context: ContextTypes.DEFAULT_TYPE, supabase_user_uuid: str) -> None:
+    """Classifies the intent of text from a linked user (typed or transcribed), runs it and replies."""
+    # Start loading task context now so the DB round trip overlaps intent classification
+    ctx_task = asyncio.create_task(fetch_task_context(supabase_user_uuid))
     intent_data = await determine_intent_and_params(user_text)
     intent = intent_data.get("intent", "UNKNOWN")
     params = intent_data.get("params", {})
-    reply_text = "Processing..." # Default message, should be replaced
+    # Write intents don't use the context; drop it so a pre-write snapshot isn't cached
+    if intent in WRITE_INTENTS: ctx_task.cancel()
 
     try:
-        # --- Intent Execution Logic ---
-        if intent == "CREATE_TASK":
-            task_name = params.get("name")
-            if task_name:
-                task_desc = params.get("description")
-                res = supabase.table("tasks").insert({
-                    "user_id": supabase_user_uuid, "name": task_name, "description": task_desc, "status": "To do"
-                }).execute()
-                if res.data: reply_text = f"✅ Task created: '{task_name}'"
-                else: reply_text = f"⚠️ DB Error creating task. Check logs."; logger.error(f"Task insert failed: {res}")
-            else: reply_text = "⚠️ Task name missing for creation."
-
-        elif intent == "ADD_CONTEXT":
-            task_query = params.get("task_query")
-            content = params.get("content")
-            if task_query and content:
-                task_id = await find_task_id(supabase_user_uuid, task_query)
-                if task_id:
-                    res = supabase.table("messages").insert({
-                        "task_id": task_id, "user_id": None, "sender_email": "LiquidLM-Bot",
-                        "content": content, "is_external": False # Mark as internal bot message maybe?
-                    }).execute()
-                    if res.data: reply_text = f"✅ Added note to task ID {task_id}."
-                    else: reply_text = f"⚠️ DB Error adding note. Check logs."; logger.error(f"Msg insert failed: {res}")
-                else: reply_text = f"⚠️ Task matching '{task_query}' not found to add note."
-            else: reply_text = "⚠️ Missing task query or note content."
-
-        elif intent == "SET_DEADLINE":
-            task_query = params.get("task_query")
-            deadline_str = params.get("deadline")
-            if task_query and deadline_str:
-                valid_deadline = None
-                try: # Basic YYYY-MM-DD check
-                    datetime.strptime(deadline_str, '%Y-%m-%d'); valid_deadline = deadline_str
-                except (ValueError, TypeError):
-                    logger.warning(f"Deadline '{deadline_str}' not YYYY-MM-DD. Add parsing logic if needed.")
-                    # TODO: Add robust date parsing here using dateparser library or similar if required
-                    # For now, only accept YYYY-MM-DD
-
-                if not valid_deadline: reply_text = f"⚠️ Could not parse deadline '{deadline_str}'. Please use YYYY-MM-DD format."
-                else:
-                    task_id = await find_task_id(supabase_user_uuid, task_query)
-                    if task_id:
-                        res = supabase.table("tasks").update({"deadline": valid_deadline}).eq("id", task_id).eq("user_id", supabase_user_uuid).execute()
-                        if res.data: reply_text = f"✅ Deadline set for task ID {task_id} to {valid_deadline}."
-                        else: reply_text = f"⚠️ DB Error setting deadline (Task ID: {task_id}). Check logs."; logger.error(f"Deadline update failed: {res}")
-                    else: reply_text = f"⚠️ Task matching '{task_query}' not found to set deadline."
-            else: reply_text = "⚠️ Missing task query or deadline."
-
-        elif intent == "ANSWER_QUESTION":
-            task_context = await fetch_task_context(supabase_user_uuid)
-            # Consider adding a system prompt for better answers
-            prompt = f"System: You are a helpful assistant answering questions based ONLY on the provided task context.\nUser: {user_text}\nContext:\n---\n{task_context}\n---\nAnswer:"
-            reply_text = await get_ollama_response(prompt)
-
-        else: # UNKNOWN
-            # Default fallback if intent is unclear
-            task_context = await fetch_task_context(supabase_user_uuid)
-            prompt = f"System: You are a helpful assistant. The user said '{user_text}', which wasn't a specific command. Respond helpfully based on their tasks if relevant, or have a brief general chat.\nContext:\n---\n{task_context}\n---\nResponse:"
-            reply_text = await get_ollama_response(prompt)
-            # reply_text = "Sorry, I couldn't determine a specific action. How can I help with your tasks?"
-
-
+        handler = INTENT_HANDLERS.get(intent, _do_unknown)
+        reply_text = await handler(user_text, supabase_user_uuid, params, ctx_task, update.message)
     except Exception as e:
-        logger.error(f"Error processing message for user {supabase_user_uuid}: {e}", exc_info=True)
+        logger.error("Error processing message for user %s: %s", supabase_user_uuid, e, exc_info=True)
         reply_text = "❌ Sorry, an internal error occurred while processing your request."
 
-    # Send Final Reply
-    await update.message.reply_text(reply_text)
+    # Send Final Reply (streamed intents have already replied)
+    if reply_text: await update.message.reply_text(reply_text)
 
 
 async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -612,34 +895,127 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
 
         file_id = voice.file_id
         voice_file = await context.bot.get_file(file_id)
-        # Ensure temp directory exists if needed, or save in current dir
-        download_path = f"temp_audio_{uuid.uuid4()}.ogg"
-        await voice_file.download_to_drive(download_path)
-        logger.info(f"Downloaded voice file to: {download_path} for user {supabase_user_uuid}")
+        # Keep the voice note in memory: no temp file to write, re-read and clean up
+        audio_bytes = bytes(await voice_file.download_as_bytearray())
+        logger.info("Downloaded voice file (%d bytes) for user %s", len(audio_bytes), supabase_user_uuid)
 
-        # Optional mime type check
-        try:
-            mime = magic.from_file(download_path, mime=True)
-            logger.info(f"Detected mime type: {mime}")
-            if not mime.startswith('audio/'): logger.warning(f"Unexpected mime type {mime}")
-        except Exception as magic_e: logger.warning(f"python-magic check failed: {magic_e}")
+        if not audio_bytes.startswith(OGG_MAGIC): logger.warning("Unexpected voice format (header %r)", audio_bytes[:4])
 
         await context.bot.send_chat_action(chat_id=chat_id, action='typing')
-        transcribed_text = await transcribe_audio(download_path) # Cleans up file
+        transcribed_text = await transcribe_audio(audio_bytes)
 
         if transcribed_text:
-            logger.info(f"Voice transcribed for user {supabase_user_uuid}. Processing as text...")
-            fake_update = update # Reuse update object
-            fake_update.message.text = transcribed_text # Set text content
-            await handle_text_message(fake_update, context) # Process
+            logger.info("Voice transcribed for user %s. Processing as text...", supabase_user_uuid)
+            await _process_user_text(transcribed_text, update, context, supabase_user_uuid)
+        elif transcribed_text == "":
+            await update.message.reply_text("No speech detected in that voice note. Please try again or send text.")
         else:
             await update.message.reply_text("Sorry, I couldn't transcribe the audio. Please ensure it's clear or send text.")
 
     except Exception as e:
-        logger.error(f"Error handling voice message for user {supabase_user_uuid}: {e}", exc_info=True)
+        logger.error("Error handling voice message for user %s: %s", supabase_user_uuid, e, exc_info=True)
         await update.message.reply_text("❌ An error occurred processing the voice message.")
 
 
+# --- Update Processing ---
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different users concurrently, but each user's updates one at a time, in order.
+
+    Keeps the /link ConversationHandler correct (it expects sequential updates per user) and stops
+    e.g. "create task X" then "set deadline for X" from finishing out of order.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # Entries vanish once no update of that user is running or waiting
+        self._user_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if not user: await coroutine; return
+        lock = self._user_locks.get(user.id)
+        if lock is None: lock = self._user_locks[user.id] = asyncio.Lock()
+        # Runs inside PTB's concurrency slot, so a user's queued updates each hold a slot while they wait
+        async with lock:
+            await coroutine
+
+    async def initialize(self) -> None: pass
+    async def shutdown(self) -> None: pass
+
+# --- Conversation Persistence ---
+
+class RedisPersistence(BasePersistence):
+    """Stores ConversationHandler states in Redis so an in-progress /link survives a bot restart.
+
+    Only conversations are persisted (user/chat/bot data aren't used by the bot). Each state is
+    one key, conv:<handler name>:<chat id>:<user id>, expiring with the conversation timeout.
+    """
+
+    def __init__(self, client: "aioredis.Redis", ttl: float, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval, # PTB batches state writes; keep the window short
+        )
+        self.client = client
+        self.ttl = int(ttl)
+
+    async def get_conversations(self, name: str) -> dict:
+        prefix = f"conv:{name}:"
+        keys = [key async for key in self.client.scan_iter(match=prefix + "*", count=1000)]
+        if not keys: return {}
+        states = await self.client.mget(keys)
+        return {
+            tuple(int(part) for part in key.decode()[len(prefix):].split(":")): orjson.loads(state)
+            for key, state in zip(keys, states) if state is not None # Expired between SCAN and MGET
+        }
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        redis_key = f"conv:{name}:" + ":".join(map(str, key))
+        if new_state is None: await self.client.delete(redis_key)
+        else: await self.client.set(redis_key, orjson.dumps(new_state), ex=self.ttl)
+
+    async def flush(self) -> None:
+        await self.client.aclose() # Called once by Application.stop() after the final state write
+
+    # Unused stores (disabled via PersistenceInput above)
+    async def get_user_data(self) -> dict: return {}
+    async def get_chat_data(self) -> dict: return {}
+    async def get_bot_data(self) -> dict: return {}
+    async def get_callback_data(self) -> None: return None
+    async def update_user_data(self, user_id: int, data: dict) -> None: pass
+    async def update_chat_data(self, chat_id: int, data: dict) -> None: pass
+    async def update_bot_data(self, data: dict) -> None: pass
+    async def update_callback_data(self, data: object) -> None: pass
+    async def drop_chat_data(self, chat_id: int) -> None: pass
+    async def drop_user_data(self, user_id: int) -> None: pass
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None: pass
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None: pass
+    async def refresh_bot_data(self, bot_data: dict) -> None: pass
+
+# --- Application Lifecycle Hooks ---
+async def post_init(application: Application) -> None:
+    """Opens the Supabase client and Postgres pool, and warms up the local Whisper model if used."""
+    global supabase, DB_POOL
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY, options=AsyncClientOptions(httpx_client=HTTP))
+    logger.info("Supabase client initialized.")
+    DB_POOL = await asyncpg.create_pool(
+        dsn=SUPABASE_DB_URL, min_size=5, max_size=20, max_inactive_connection_lifetime=300,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE
+    )
+    logger.info("Postgres connection pool initialized.")
+    if WHISPER_LOCAL_MODEL and WhisperModel:
+        await asyncio.to_thread(_warm_up_whisper)
+        logger.info("Local Whisper model warmed up.")
+
+async def post_shutdown(application: Application) -> None:
+    """Closes the Postgres pool and HTTP clients once the bot has stopped."""
+    if DB_POOL: await DB_POOL.close()
+    if whisper_client: await whisper_client.close()
+    await HTTP.aclose()
+    await OLLAMA_HTTP.aclose()
+    logger.info("Postgres pool and HTTP clients closed.")
+
 # --- Main Bot Function ---
 def main() -> None:
     """Configures and starts the Telegram bot."""
@@ -648,25 +1024,50 @@ def main() -> None:
     if not TELEGRAM_TOKEN: logger.critical("Missing TELEGRAM_BOT_TOKEN"); return
     if not SUPABASE_URL: logger.critical("Missing SUPABASE_URL"); return
     if not SUPABASE_KEY: logger.critical("Missing SUPABASE_SERVICE_KEY"); return
+    if not SUPABASE_DB_URL: logger.critical("Missing SUPABASE_DB_URL"); return
     if not OLLAMA_BASE_URL: logger.critical("Missing OLLAMA_BASE_URL"); return
     if not OLLAMA_MODEL: logger.critical("Missing OLLAMA_MODEL"); return
     if not mailgun_configured: logger.warning("Mailgun is not configured. Email features disabled.")
-    if not supabase: logger.critical("Supabase client failed init. Exiting."); return
     # Add check for Whisper config if needed (e.g., require OpenAI key or specific local setup)
 
     logger.info("LiquidLM Telegram Bot Starting...")
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    builder = Application.builder().token(TELEGRAM_TOKEN)
+    http_version = "2" # api.telegram.org speaks HTTP/2; a self-hosted Bot API server only HTTP/1.1
+    if REDIS_URL and aioredis:
+        builder = builder.persistence(RedisPersistence(aioredis.from_url(REDIS_URL), ttl=CONV_TIMEOUT_S))
+        logger.info("Persisting conversation state in Redis.")
+    if TELEGRAM_API_BASE_URL:
+        # Local Bot API server: skips the round trip to api.telegram.org on every call/poll, and in
+        # local mode file downloads (voice notes) are read straight from the server's disk
+        file_url = TELEGRAM_API_FILE_URL or TELEGRAM_API_BASE_URL.rsplit("/bot", 1)[0] + "/file/bot"
+        builder = builder.base_url(TELEGRAM_API_BASE_URL).base_file_url(file_url).local_mode(TELEGRAM_LOCAL_MODE)
+        http_version = "1.1"
+        logger.info("Using Bot API server at %s (local mode: %s)", TELEGRAM_API_BASE_URL, TELEGRAM_LOCAL_MODE)
+    application = (
+        builder
+        # Pooled (HTTP/2 where supported) connections to the Bot API so replies/edits reuse one session
+        .connection_pool_size(100)
+        .http_version(http_version)
+        .get_updates_http_version(http_version)
+        # Handle up to 32 updates at once so one slow Ollama/Whisper call doesn't stall other users;
+        # each user's own updates still run one at a time, in order
+        .concurrent_updates(PerUserUpdateProcessor(32))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # --- Add Handlers ---
     # 1. Linking Conversation (must be before generic message handlers)
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('link', link_start)],
         states={
-            ASK_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, link_ask_code)],
-            ASK_CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, link_verify_code)],
+            LinkState.ASK_EMAIL: [MessageHandler(TEXT_NO_CMD, link_ask_code)],
+            LinkState.ASK_CODE: [MessageHandler(TEXT_NO_CMD, link_verify_code)],
         },
         fallbacks=[CommandHandler('cancel', link_cancel)],
-        conversation_timeout=timedelta(minutes=5).total_seconds()
+        conversation_timeout=CONV_TIMEOUT_S,
+        name="link", persistent=bool(application.persistence) # Stored in Redis when REDIS_URL is set
     )
     application.add_handler(conv_handler, group=1) # Assign group if needed for priority
 
@@ -676,7 +1077,7 @@ def main() -> None:
     # Add /help command handler if desired
 
     # 3. Generic Message Handlers (lower priority group or added after conversation)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    application.add_handler(MessageHandler(TEXT_NO_CMD, handle_text_message))
     application.add_handler(MessageHandler(filters.VOICE, handle_voice_message))
 
     # --- Run Bot ---
@@ -0,0 +1,5 @@
+-- Trigram index backing the bot's fuzzy task lookup (find_task_id in main.py).
+-- Serves both the ILIKE '%query%' substring match and the pg_trgm similarity (%) operator.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS tasks_name_trgm ON public.tasks USING gin (name gin_trgm_ops);
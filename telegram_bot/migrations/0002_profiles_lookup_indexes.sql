@@ -0,0 +1,5 @@
+-- Indexes for the bot's profile lookups (get_profile_by_telegram_id / get_user_uuid_by_email in main.py).
+CREATE INDEX IF NOT EXISTS profiles_telegram_id_idx ON public.profiles (telegram_id);
+
+-- Functional index so the case-insensitive email match is an index lookup instead of a scan.
+CREATE UNIQUE INDEX IF NOT EXISTS profiles_email_lower_idx ON public.profiles (lower(email));